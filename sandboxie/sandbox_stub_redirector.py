@@ -1,16 +1,15 @@
 import sys
+import contextlib
+import json
 import subprocess
 import win32namedpipe
-import clize
 
 
-def main(
-    *, args: (str, 'a', clize.parameters.multi(min=1)), stdin: str = None, stdout: str = None, stderr: str = None
-):
+def main(args: list[str], stdin: str = None, stdout: str = None, stderr: str = None):
     '''
     A stub for launching applications in Sandboxie.
 
-    :param args: An argument to launch app. This option can be specified multiple times.
+    :param args: Arguments to launch app.
     :type args: list[str]
     :param stdin: The path for stdin redirection.
     :type stdin: str, optional
@@ -20,21 +19,59 @@ def main(
     :type stderr: str, optional
     '''
 
-    if stdin is not None:
-        stdin = win32namedpipe.Win32NamedPipeClient(stdin, inbound=True, outbound=False).connect()
+    with contextlib.ExitStack() as stack:
+        if stdin is not None:
+            stdin = stack.enter_context(
+                win32namedpipe.Win32NamedPipeClient(stdin, inbound=True, outbound=False).connect()
+            )
 
-    if stdout is not None:
-        stdout = win32namedpipe.Win32NamedPipeClient(stdout, inbound=False, outbound=True).connect()
+        if stdout is not None:
+            stdout = stack.enter_context(
+                win32namedpipe.Win32NamedPipeClient(stdout, inbound=False, outbound=True).connect()
+            )
 
-    if stderr is not None:
-        stderr = win32namedpipe.Win32NamedPipeClient(stderr, inbound=False, outbound=True, buffering=0).connect()
+        if stderr is not None:
+            stderr = stack.enter_context(
+                win32namedpipe.Win32NamedPipeClient(stderr, inbound=False, outbound=True, buffering=0).connect()
+            )
 
-    with stdin:
-        with stdout:
-            with stderr:
-                proc = subprocess.run(args, stdin=stdin, stdout=stdout, stderr=stderr)
-                sys.exit(proc.returncode)
+        proc = subprocess.run(args, stdin=stdin, stdout=stdout, stderr=stderr)
+        sys.exit(proc.returncode)
+
+
+def parse_argv(argv: list[str]) -> dict:
+    '''
+    Parses the command line given by `Sandboxie.piped_execute()`. This is done by hand rather than with an argument
+    parsing library, as the stub is launched on every piped execution and its startup time matters.
+
+    Accepted options are `--stdin=PATH`, `--stdout=PATH`, `--stderr=PATH`, `-aARG` and `--args-file=PATH`. `-aARG` is
+    an argument to launch app and can be specified multiple times. `--args-file=PATH` points to a JSON file containing
+    the list of arguments, used instead of `-a` when the command line is too long.
+
+    :param argv: Command line arguments, excluding the program name.
+    :type argv: list[str]
+    :return: Keyword arguments for `main()`.
+    :rtype: dict
+    '''
+
+    kwargs = {'args': []}
+    for arg in argv:
+        if arg.startswith('-a'):
+            kwargs['args'].append(arg[2:])
+        elif arg.startswith('--args-file='):
+            with open(arg[len('--args-file='):], encoding='utf-8') as f:
+                kwargs['args'].extend(json.load(f))
+        elif arg.startswith(('--stdin=', '--stdout=', '--stderr=')):
+            key, _, value = arg[2:].partition('=')
+            kwargs[key] = value
+        else:
+            raise SystemExit(f'unknown argument: {arg}')
+
+    if not kwargs['args']:
+        raise SystemExit('at least one -a or --args-file argument is required')
+
+    return kwargs
 
 
 if __name__ == '__main__':
-    clize.run(main, exit=False)
+    main(**parse_argv(sys.argv[1:]))
@@ -1,11 +1,16 @@
 import textwrap
-import re
+import codecs
 import subprocess
 import ctypes
+import ctypes.wintypes
 import winreg
 import sys
 import typing
 import os
+import stat
+import contextlib
+import tempfile
+import json
 from pathlib import Path
 from . import win32namedpipe
 
@@ -13,6 +18,13 @@ from . import win32namedpipe
 __all__ = ('SandboxiePipedProcess', 'Sandboxie')
 
 
+def _isfile(path) -> bool:
+    # Same as `Path.is_file()` but with a single bare stat call. Any failure, including a malformed path, means no.
+    try:
+        return stat.S_ISREG(os.stat(path).st_mode)
+    except OSError:
+        return False
+
 
 class SandboxiePipedProcess:
     '''
@@ -43,20 +55,25 @@ class SandboxiePipedProcess:
     def __enter__(self):
         return self
 
-    def __exit__(self, exc_type, value, traceback):
-        if self.stdout:
-            self.stdout.close()
-        if self.stderr:
-            self.stderr.close()
+    def _close_stdin(self):
         try:  # Flushing a BufferedWriter may raise an error
-            if self.stdin:
-                self.stdin.close()
+            self.stdin.close()
         except BrokenPipeError:
             pass
-        finally:
+
+    def __exit__(self, exc_type, value, traceback):
+        # Callbacks run in reverse order, and all of them run even if an earlier one raises. In particular stdin is
+        # always closed before waiting, so that a child blocked on reading it gets EOF instead of hanging us forever.
+        with contextlib.ExitStack() as stack:
             if exc_type != KeyboardInterrupt:
                 # Wait for the process to terminate, to avoid zombies.
-                self.wait()
+                stack.callback(self.wait)
+            if self.stdin:
+                stack.callback(self._close_stdin)
+            if self.stderr:
+                stack.callback(self.stderr.close)
+            if self.stdout:
+                stack.callback(self.stdout.close)
 
     def wait(self, timeout=None):
         return self._popen.wait(timeout=timeout)
@@ -71,9 +88,15 @@ class Sandboxie:
     Represents the Sandboxie application.
     '''
     _PIPE_PREFIX = r'\\.\pipe\pysandboxie_pipe'
+    # Kernel-side buffer for stdout/stderr pipes. A larger buffer lets a chatty child keep writing without stalling
+    # until we drain every few KBs.
+    _OUTPUT_PIPE_BUFFER_SIZE = 64 * 1024
+    # Thresholds on the number and the total length of arguments above which they are passed to the stub via a file
+    _STUB_ARGS_FILE_MIN_COUNT = 16
+    _STUB_ARGS_FILE_MIN_LENGTH = 2048
 
     SETTING_TEMPLATES = {
-        'default': list(filter(None, textwrap.dedent(
+        'default': tuple(filter(None, textwrap.dedent(
             # Note: These default settings are not complete -- in most cases the SbieCtrl.exe will pop-up a new list of
             #       compatibility templates when it restarts. As we won't implement all the Template.ini detection
             #       logic, we'll just go for a minimal setup instead.
@@ -87,11 +110,15 @@ class Sandboxie:
             BorderColor=#00FFFF,ttl
             '''
         ).split('\n'))),
-        'piped_execution': [rf'OpenPipePath={win32namedpipe.pipepath_unc_to_nt_namespace(_PIPE_PREFIX)}*']
+        'piped_execution': (rf'OpenPipePath={win32namedpipe.pipepath_unc_to_nt_namespace(_PIPE_PREFIX)}*',)
     }
     
     DEFAULTBOX = 'DefaultBox'
 
+    _FALLBACK_STARTPATH = Path(r'C:\Program Files\Sandboxie\Start.exe')
+    # Session ID understood by SbieDll.dll as "the session of the calling process"
+    _SBIE_CURRENT_SESSION = 0xFFFFFFFF
+
     def _locate_start(self):  # coverage: no cover
         try:
             with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, r'SYSTEM\CurrentControlSet\Services\SbieSvc') as hreg:
@@ -107,73 +134,153 @@ class Sandboxie:
                 startpath = Path(svc_imagepath).parent / 'Start.exe'
         except OSError:
             # Fallback
-            startpath = Path(r'C:\Program Files\Sandboxie\Start.exe')
+            startpath = self._FALLBACK_STARTPATH
 
-        if not startpath.is_file():
+        if not _isfile(startpath):
             raise FileNotFoundError('cannot locate sandboxie installation (Start.exe)')
 
         self._startpath = startpath
 
     def _locate_ini(self):  # coverage: no cover
         inipath = Path(winreg.ExpandEnvironmentStrings(r'%windir%\Sandboxie.ini'))
-        if not inipath.exists():
+        if not _isfile(inipath):
             inipath = self._startpath.parent / 'Sandboxie.ini'
-        if not inipath.exists():
+        if not _isfile(inipath):
             raise FileNotFoundError('cannot locate sandboxie configuration (Sandboxie.ini)')
 
         self._inipath = inipath
 
+    def _load_sbiedll(self):  # coverage: no cover
+        # Calling into SbieDll.dll directly saves spawning Start.exe for simple control requests. Fall back to Start.exe
+        # when the DLL is unavailable (e.g. 32-bit Python against 64-bit Sandboxie) or lacks the exports we use.
+        #
+        # Only exports whose signature has been the same across all supported Sandboxie versions are used here.
+        # SbieApi_ReloadConf and SbieApi_EnumProcessEx gained parameters over time, so reloading and listing processes
+        # are left to Start.exe.
+        try:
+            dll = ctypes.WinDLL(str(self._startpath.parent / 'SbieDll.dll'))
+
+            dll.SbieDll_KillAll.argtypes = (ctypes.wintypes.ULONG, ctypes.wintypes.LPCWSTR)
+            dll.SbieDll_KillAll.restype = ctypes.wintypes.BOOLEAN
+        except (OSError, AttributeError):
+            return None
+
+        return dll
+
     def _require_uac_admin(self): # coverage: no cover
         if not ctypes.windll.shell32.IsUserAnAdmin():
             raise PermissionError('This operation requires UAC admin right')
 
-    def _readini(self):
+    def _statini(self):
+        st = os.stat(self._inipath)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _cacheini(self, content_dict: dict[str, list[str]]):
+        self._ini_cache = content_dict
+        self._ini_cache_key = self._statini()
+
+    def _loadini(self):
         # The Sandboxie.ini file is inherently different from ordinary INI files and thus cannot use ConfigParser:
         # - It may have multiple entries with same key
         # - It is newline-sensitive -- SbieCtrl sometimes lose information if the newlines are not properly set.
 
-        ret = {None: []}
+        # Reuse the last parse result unless the file has been changed since then (e.g. by SbieCtrl).
+        # The returned dict is shared with the cache and must not be mutated; use `_readini()` for that.
+        if self._ini_cache is not None and self._ini_cache_key == self._statini():
+            return self._ini_cache
 
-        currentsection = None
+        # Read and decode the whole file at once rather than going through the text-mode line iterator.
+        data = memoryview(self._inipath.read_bytes())
+        # In case someone saved it with BOM. Slicing the memoryview skips it without copying the whole buffer.
+        if data[:2] == codecs.BOM_UTF16_LE:
+            data = data[2:]
 
-        with self._inipath.open('r', encoding='utf-16-le') as f:
-            # In case someone saved it with BOM
-            if f.read(1) != '\ufeff':
-                f.seek(0)
+        self._cacheini(self._parseini(str(data, 'utf-16-le')))
+        return self._ini_cache
 
-            for line in f:
-                line = line.strip('\r\n')
-                if not line:
-                    continue
+    @staticmethod
+    def _parseini(text: str) -> dict[typing.Optional[str], list[str]]:
+        ret = {None: []}
 
-                match = re.fullmatch(r'^\[(.*)\]$', line)
-                if match:
-                    currentsection = match[1]
-                    ret[currentsection] = []
+        currentlines = ret[None]
+
+        # Only CR/LF are line breaks here, same as text-mode file iteration. `str.splitlines()` would also split on
+        # characters such as U+2028 which may legitimately appear inside a value.
+        for line in text.replace('\r\n', '\n').replace('\r', '\n').split('\n'):
+            if line:
+                if line[0] == '[' and line[-1] == ']':
+                    currentlines = ret[line[1:-1]] = []
                 else:
-                    ret[currentsection].append(line)
+                    currentlines.append(line)
 
         return ret
 
+    def _readini(self):
+        return {section: list(lines) for section, lines in self._loadini().items()}
+
+    def _sandbox_exists(self, name: str) -> bool:
+        return name in self._loadini()
+
+    @staticmethod
+    def _formatini_section(section: typing.Optional[str], lines: list[str]) -> str:
+        header = f'\r\n[{section}]\r\n\r\n' if section is not None else ''
+        return ''.join([header, *(f'{line}\r\n' for line in lines)])
+
     def _writeini(self, content_dict: dict[str, list[str]]):
         self._require_uac_admin()
 
-        with self._inipath.open('w', encoding='utf-16-le', newline='\r\n') as f:
-            # The first entry should have key None
-            assert next(iter(content_dict)) is None
+        # The first entry should have key None
+        assert next(iter(content_dict)) is None
+
+        # Encode the whole content at once and write it in binary mode, bypassing the text layer.
+        content = ''.join(self._formatini_section(section, lines) for section, lines in content_dict.items())
+        self._inipath.write_bytes(codecs.BOM_UTF16_LE + content.encode('utf-16-le'))
+
+        # Cache what a re-read would give, not `content_dict` itself: e.g. empty lines are dropped by the parser.
+        self._cacheini(self._parseini(content))
+
+    def _appendini(self, section: str, lines: list[str]):
+        # Sections are simply concatenated in Sandboxie.ini, so adding one does not require rewriting the whole file.
+        self._require_uac_admin()
+
+        cfg = self._loadini()
 
-            for section, lines in content_dict.items():
-                if section is not None:
-                    f.write(f'\n[{section}]\n\n')
-                for line in lines:
-                    f.write(f'{line}\n')
+        content = self._formatini_section(section, lines)
+        with self._inipath.open('ab') as f:
+            f.write(content.encode('utf-16-le'))
+
+        # `cfg` is the cache itself and reflects the file just before appending. Merge in the appended part as the
+        # parser would see it; it starts with a section header so there is nothing before it.
+        appended = self._parseini(content)
+        del appended[None]
+        cfg.update(appended)
+        self._cacheini(cfg)
 
     def _reloadini(self):
-        return subprocess.run([self._startpath, '/reload'], check=True)
+        if not self._autoreload:
+            # Deferred until the outermost `batch()` block exits
+            self._pending_reload = True
+            return
+
+        self._pending_reload = False
+        subprocess.run([self._startpath, '/reload'], check=True, **self._start_control_kwargs)
 
     def __init__(self):
         self._locate_start()
         self._locate_ini()
+        self._sbiedll = self._load_sbiedll()
+        self._ini_cache = None
+        self._ini_cache_key = None
+        self._autoreload = True
+        self._pending_reload = False
+        # Start.exe invocations that merely control Sandboxie (reload, terminate, ...) need neither a console nor a
+        # visible window.
+        self._start_control_kwargs = dict(
+            startupinfo=subprocess.STARTUPINFO(
+                dwFlags=subprocess.STARTF_USESHOWWINDOW, wShowWindow=subprocess.SW_HIDE
+            ),
+            creationflags=subprocess.CREATE_NO_WINDOW
+        )
         self._subprocess_debugging = False
 
     def enable_subprocess_debugging(self, enable: bool): # coverage: no cover
@@ -198,6 +305,26 @@ class Sandboxie:
 
         self._subprocess_debugging = enable
 
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        A context manager that defers reloading the Sandboxie configuration until the block exits. Use this when making
+        multiple changes to the sandboxes (e.g. `create_sandbox()` followed by `set_sandbox_settings()`) so that the
+        configuration is reloaded only once, instead of once per change. Nested blocks are allowed; only the outermost
+        one triggers the reload.
+        '''
+
+        if not self._autoreload:
+            yield self
+            return
+
+        self._autoreload = False
+        try:
+            yield self
+        finally:
+            self._autoreload = True
+            if self._pending_reload:
+                self._reloadini()
 
     def make_sandbox_setting(self, templates: str = 'default', settings: typing.Optional[list[str]] = None):
         '''
@@ -231,16 +358,12 @@ class Sandboxie:
         :param exist_ok: If false and there are already a sandbox with a same name, FileExistsError will occur.
         :type exist_ok: bool, optional
         '''
-        cfg = self._readini()
-
-        if name in cfg:
+        if self._sandbox_exists(name):
             if not exist_ok:
                 raise FileExistsError(f'sandbox "{name}" already exists')
             return
 
-        cfg[name] = settings or []
-
-        self._writeini(cfg)
+        self._appendini(name, settings or [])
         self._reloadini()
 
     def get_sandbox_settings(self, name: str = DEFAULTBOX) -> list[str]:
@@ -252,8 +375,7 @@ class Sandboxie:
         :return: List of strings, each of which represents an entry (line).
         :rtype: list[str]
         '''
-        cfg = self._readini()
-        return cfg[name]
+        return list(self._loadini()[name])
 
     def set_sandbox_settings(self, name: str = DEFAULTBOX, settings: typing.Optional[list[str]] = None):
         '''
@@ -281,17 +403,29 @@ class Sandboxie:
         '''
         Terminates all processes in a sandbox.
 
-        If the target sandbox is missing, raises FileNotFoundError.
+        If the target sandbox is missing, raises FileNotFoundError. If the processes cannot be terminated, raises
+        OSError.
 
         :param name: Name of the sandbox.
         :type name: str, optional
         '''
-        cfg = self._readini()
-
-        if name not in cfg:
+        if not self._sandbox_exists(name):
             raise FileNotFoundError(f'sandbox "{name}" not found')
 
-        subprocess.run([self._startpath, f'/box:{name}', '/terminate'], check=True)
+        self._terminate_sandbox_processes_nocheck(name)
+
+    def _terminate_sandbox_processes_nocheck(self, name: str):
+        if self._sbiedll is None:
+            try:
+                subprocess.run(
+                    [self._startpath, f'/box:{name}', '/terminate'], check=True, **self._start_control_kwargs
+                )
+            except subprocess.CalledProcessError as e:
+                raise OSError(f'cannot terminate processes in sandbox "{name}"') from e
+            return
+
+        if not self._sbiedll.SbieDll_KillAll(self._SBIE_CURRENT_SESSION, name):
+            raise OSError(f'cannot terminate processes in sandbox "{name}"')
 
     def listpids(self, name: str = DEFAULTBOX) -> list[int]:
         '''
@@ -302,13 +436,14 @@ class Sandboxie:
         :param name: Name of the sandbox.
         :type name: str, optional
         '''
-        cfg = self._readini()
-
-        if name not in cfg:
+        if not self._sandbox_exists(name):
             raise FileNotFoundError(f'sandbox "{name}" not found')
 
-        output = subprocess.check_output([self._startpath, f'/box:{name}', '/listpids'])
-        return [int(pidstr) for pidstr in output.split()[1:]] # 0th is a length parameter
+        output = subprocess.check_output(
+            [self._startpath, f'/box:{name}', '/listpids'], **self._start_control_kwargs
+        )
+        # The output is kept as bytes; `int()` parses ASCII digits in bytes directly, sparing the decoding step.
+        return list(map(int, output.split()[1:])) # 0th is a length parameter
 
     def delete_content(self, name: str = DEFAULTBOX):
         '''
@@ -319,14 +454,17 @@ class Sandboxie:
         :param name: Name of the sandbox.
         :type name: str, optional
         '''
-        cfg = self._readini()
-
-        if name not in cfg:
+        if not self._sandbox_exists(name):
             raise FileNotFoundError(f'sandbox "{name}" not found')
 
-        self.terminate_sandbox_processes(name=name)
+        self._delete_content_nocheck(name)
 
-        subprocess.run([self._startpath, f'/box:{name}', 'delete_sandbox_silent'], check=True)
+    def _delete_content_nocheck(self, name: str):
+        self._terminate_sandbox_processes_nocheck(name)
+
+        subprocess.run(
+            [self._startpath, f'/box:{name}', 'delete_sandbox_silent'], check=True, **self._start_control_kwargs
+        )
 
     def remove_sandbox(self, name: str, preserve_content: bool = False):
         '''
@@ -346,9 +484,10 @@ class Sandboxie:
         if name not in cfg:
             raise FileNotFoundError(f'sandbox "{name}" not found')
 
-        self.terminate_sandbox_processes(name)
-        if not preserve_content:
-            self.delete_content(name)
+        if preserve_content:
+            self._terminate_sandbox_processes_nocheck(name)
+        else:
+            self._delete_content_nocheck(name)  # This terminates the processes as well
 
         del cfg[name]
 
@@ -411,7 +550,8 @@ class Sandboxie:
         return proc
 
     def piped_execute(
-        self, cmd: list[str], name: str = DEFAULTBOX, uac: bool = False, hide_window: bool = False
+        self, cmd: list[str], name: str = DEFAULTBOX, uac: bool = False, hide_window: bool = False,
+        stdin: bool = True, stdout: bool = True, stderr: bool = True
     ) -> SandboxiePipedProcess:
         '''
         Executes a process in a sandbox with stdin/stdout/stderr piped, and returns a `SandboxiePipedProcess` handle.
@@ -428,34 +568,63 @@ class Sandboxie:
         :type uac: bool, optional
         :param hide_window: True if you wish to hide the window.
         :type hide_window: bool, optional
+        :param stdin: Whether to pipe stdin. If false, the `stdin` attribute of the returned object will be None.
+        :type stdin: bool, optional
+        :param stdout: Whether to pipe stdout. If false, the `stdout` attribute of the returned object will be None.
+        :type stdout: bool, optional
+        :param stderr: Whether to pipe stderr. If false, the `stderr` attribute of the returned object will be None.
+        :type stderr: bool, optional
         :return: the `SandboxiePipedProcess` object.
         :rtype: SandboxiePipedProcess
         '''
-        stdin_pipeserver = win32namedpipe.temppipeserver(
-            self._PIPE_PREFIX, inbound=False, outbound=True
-        )
-        stdout_pipeserver = win32namedpipe.temppipeserver(
-            self._PIPE_PREFIX, inbound=True, outbound=False
-        )
-        stderr_pipeserver = win32namedpipe.temppipeserver(
-            self._PIPE_PREFIX, inbound=True, outbound=False, buffering=0
-        )
+        requested = {'stdin': stdin, 'stdout': stdout, 'stderr': stderr}
+        pipeserver_kwargs = {
+            'stdin': dict(inbound=False, outbound=True),
+            'stdout': dict(inbound=True, outbound=False, buffer_size=self._OUTPUT_PIPE_BUFFER_SIZE),
+            'stderr': dict(inbound=True, outbound=False, buffering=0, buffer_size=self._OUTPUT_PIPE_BUFFER_SIZE),
+        }
+        pipeservers = {
+            stream: win32namedpipe.temppipeserver(self._PIPE_PREFIX, **kwargs)
+            for stream, kwargs in pipeserver_kwargs.items() if requested[stream]
+        }
+
+        # Accept non-str arguments (e.g. `pathlib.Path`) the same way `f'-a{arg}'` does
+        cmd = [str(arg) for arg in cmd]
+
+        # Long command lines are handed over through a file, which also keeps us away from the 32K command line limit.
+        # The stub reads it before connecting to any pipe, so it is safe to delete once the connections are made.
+        # Without any pipe there is no such point to delete it at, so the arguments always go on the command line then.
+        args_file = None
+        if pipeservers and (
+            len(cmd) > self._STUB_ARGS_FILE_MIN_COUNT or sum(map(len, cmd)) > self._STUB_ARGS_FILE_MIN_LENGTH
+        ):
+            with tempfile.NamedTemporaryFile(
+                'w', encoding='utf-8', suffix='.json', prefix='pysandboxie_args_', delete=False
+            ) as f:
+                json.dump(cmd, f)
+                args_file = f.name
+            stub_args = [f'--args-file={args_file}']
+        else:
+            stub_args = [f'-a{arg}' for arg in cmd]
 
         cmd = [
             sys.executable, str(Path(__file__).parent / 'sandbox_stub_redirector.py'),
-            f'--stdin={stdin_pipeserver.name}',
-            f'--stdout={stdout_pipeserver.name}',
-            f'--stderr={stderr_pipeserver.name}'
-        ] + [f'-a{arg}' for arg in cmd]
+            *(f'--{stream}={pipeserver.name}' for stream, pipeserver in pipeservers.items())
+        ] + stub_args
 
-        stdin = stdin_pipeserver.accept(skip_connection_wait=True)
-        stdout = stdout_pipeserver.accept(skip_connection_wait=True)
-        stderr = stderr_pipeserver.accept(skip_connection_wait=True)
+        try:
+            pipefiles = {
+                stream: pipeserver.accept(skip_connection_wait=True) for stream, pipeserver in pipeservers.items()
+            }
 
-        popen = self.execute(cmd, name=name, uac=uac, hide_window=hide_window)
+            popen = self.execute(cmd, name=name, uac=uac, hide_window=hide_window)
 
-        stdin_pipeserver.wait_for_connection(stdin)
-        stdout_pipeserver.wait_for_connection(stdout)
-        stderr_pipeserver.wait_for_connection(stderr)
+            # The pipes are already listening, so the stub may connect them in any order while we wait for each in
+            # turn; the total wait is bound by the slowest connection anyway.
+            for stream, pipeserver in pipeservers.items():
+                pipeserver.wait_for_connection(pipefiles[stream])
+        finally:
+            if args_file is not None:
+                os.unlink(args_file)
 
-        return SandboxiePipedProcess(popen, stdin, stdout, stderr)
+        return SandboxiePipedProcess(popen, pipefiles.get('stdin'), pipefiles.get('stdout'), pipefiles.get('stderr'))
@@ -41,6 +41,22 @@ def test_broken_pipe(sbie):
         # the BrokenPipeError would have been silently swallowed by sp.__exit__()
     assert sp.returncode == 0
 
+def test_stdout_only(sbie):
+    sp = sbie.piped_execute(['cmd', '/c', 'echo', 'yay'], name='testpy', hide_window=True, stdin=False, stderr=False)
+    with sp:
+        assert sp.stdin is None
+        assert sp.stderr is None
+        assert sp.stdout.read().strip() == b'yay'
+    assert sp.returncode == 0
+
+def test_long_args(sbie):
+    # Enough arguments to make piped_execute() pass them through a file
+    words = [f'word{i}' for i in range(32)]
+    sp = sbie.piped_execute(['cmd', '/c', 'echo', *words], name='testpy', hide_window=True)
+    with sp:
+        assert sp.stdout.read().split() == [word.encode() for word in words]
+    assert sp.returncode == 0
+
 def test_settings(sbie):
     if not UAC:
         return
@@ -56,6 +72,30 @@ def test_settings(sbie):
         # Restore to default
         sbie.set_sandbox_settings('testpy', sbie.make_sandbox_setting('default,piped_execution'))
 
+def test_batch(sbie, monkeypatch):
+    if not UAC:
+        return
+
+    reloads = []
+    original_reloadini = sbie._reloadini
+    def counting_reloadini():
+        if sbie._autoreload:
+            reloads.append(None)
+        return original_reloadini()
+    monkeypatch.setattr(sbie, '_reloadini', counting_reloadini)
+
+    try:
+        with sbie.batch():
+            sbie.set_sandbox_settings('testpy', sbie.make_sandbox_setting('default', ['abc=def']))
+            sbie.set_sandbox_settings('testpy', sbie.make_sandbox_setting('default', ['ghi=jkl']))
+            assert len(reloads) == 0
+        assert len(reloads) == 1
+        assert sbie.get_sandbox_settings('testpy')[-1] == 'ghi=jkl'
+
+    finally:
+        # Restore to default
+        sbie.set_sandbox_settings('testpy', sbie.make_sandbox_setting('default,piped_execution'))
+
 def test_duplicates_and_nonexistents(sbie):
     if not UAC:
         return